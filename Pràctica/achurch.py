@@ -4,10 +4,16 @@ from telegram.ext import InlineQueryHandler
 from telegram import InlineQueryResultArticle, InputTextMessageContent
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
 from telegram import Update
+import argparse
+import asyncio
+import functools
 import logging
+import time
 import uuid
 import pydot
-from dataclasses import dataclass
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
 
 from antlr4 import *
 from lcLexer import lcLexer
@@ -223,35 +229,27 @@ def cercarAbstraccions(arbre: Arbre, cap: str, varsConfl: set, varsVistes: set):
                 return Abstraccio(cap2, nouCos), antigaVar, novaVar
 
 
-async def alphaConversio(abstr: Abstraccio, aplDre: Arbre, update: Update, context: ContextTypes.DEFAULT_TYPE):
+def alphaConversio(abstr: Abstraccio, aplDre: Arbre):
     """
     Realitza una alpha-conversió si és necessària a una abstracció, basada en l'arbre de la dreta de l'aplicació.
 
     Paràmetres:
         abstr (Abstraccio): L'abstracció a la qual es pot aplicar l'alpha-conversió.
         aplDre (Arbre): L'arbre de la dreta de l'aplicació.
-        update (Update): L'actualització de Telegram per respondre amb el resultat de l'alpha-conversió.
-        context (ContextTypes.DEFAULT_TYPE): El context de l'execució de la conversa de Telegram.
 
     Retorn:
         Abstraccio: L'abstracció modificada després de l'alpha-conversió, si és necessària.
-        bool: Cert si s'ha realitzat una alpha-conversió, Fals si no s'ha realitzat cap alpha-conversió.
+        str: El valor de l'antiga variable lligada que ha estat substituïda, o None si no hi ha hagut alpha-conversió.
+        str: El valor de la nova variable lligada que ha estat substituïda, o None si no hi ha hagut alpha-conversió.
     """
     varsDre = obtenirVariables(aplDre)
     varsVistes = obtenirVariables(abstr) | varsDre
     nouCos, antigaVar, novaVar = cercarAbstraccions(abstr.cos, abstr.cap, varsDre, varsVistes)
 
     if antigaVar:
-        novaAbstr = Abstraccio(abstr.cap, nouCos)
-        str_abstr = getArbreSemantic(abstr)
-        str_novaAbstr = getArbreSemantic(novaAbstr)
-
-        if context.user_data['mostrar_conversions']:
-            await update.message.reply_text(str_abstr + ' → α(' + antigaVar + '→' + novaVar + ') → ' + str_novaAbstr)
-        return novaAbstr, True
-
+        return Abstraccio(abstr.cap, nouCos), antigaVar, novaVar
     else:
-        return abstr, False
+        return abstr, None, None
 
 
 def substitueixVariable(arbre: Arbre, var: str, subst: Arbre) -> Arbre:
@@ -283,30 +281,117 @@ def substitueixVariable(arbre: Arbre, var: str, subst: Arbre) -> Arbre:
             return Abstraccio(cap, terme)
 
 
-async def betaReduccio(abstr: Abstraccio, subst: Arbre, arbreAntic: Arbre, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Arbre:
+def betaReduccio(abstr: Abstraccio, subst: Arbre) -> Arbre:
     """
     Realitza una beta reducció substituint la variable 'abstr.cap' per l'arbre 'subst' en 'abstr.cos'.
 
     Paràmetres:
         abstr (Abstraccio): L'abstracció en la qual es realitzarà la beta reducció.
         subst (Arbre): L'arbre de substitució que s'utilitzarà en lloc de la variable 'abstr.cap'.
-        arbreAntic (Arbre): L'arbre original abans de la beta reducció.
-        update (Update): L'actualització de Telegram per respondre amb el resultat de la beta reducció.
-        context (ContextTypes.DEFAULT_TYPE): El context de l'execució de la conversa de Telegram.
 
     Retorn:
         Arbre: L'arbre modificat després de realitzar la beta reducció.
     """
-    nouArbre = substitueixVariable(abstr.cos, abstr.cap, subst)
-    str_arbreAntic = getArbreSemantic(arbreAntic)
-    str_nouArbre = getArbreSemantic(nouArbre)
+    return substitueixVariable(abstr.cos, abstr.cap, subst)
+
+
+@dataclass
+class Pas:
+    tipus: str  # 'α' per a les alpha-conversions i 'β' per a les beta reduccions
+    abans: Arbre  # Subarbre abans del pas: l'abstracció convertida o el redex
+    despres: Arbre  # Subarbre després del pas
+    antigaVar: str | None = None
+    novaVar: str | None = None
+    cami: str = ''  # Camí des de l'arrel fins al redex: 'e' (esquerra), 'd' (dreta) o 'c' (cos)
+
+
+def reduirPas(arbre: Arbre):
+    """
+    Realitza el següent pas d'avaluació (una alpha-conversió o una beta reducció) de l'arbre semàntic,
+    sense enviar cap missatge.
+
+    Paràmetres:
+        arbre (Arbre): L'arbre semàntic a avaluar.
+
+    Retorn:
+        Arbre: L'arbre modificat després del pas.
+        Pas: El pas realitzat, o None si l'arbre ja està en forma normal.
+    """
+    match arbre:
+        case Abstraccio(cap, cos):
+            nouCos, pas = reduirPas(cos)
+            if pas:
+                pas.cami = 'c' + pas.cami
+            return Abstraccio(cap, nouCos), pas
+
+        case Aplicacio(esq, dre):
+            if isinstance(esq, Abstraccio):
+                novaEsq, antigaVar, novaVar = alphaConversio(esq, dre)
+                if antigaVar:
+                    return Aplicacio(novaEsq, dre), Pas('α', esq, novaEsq, antigaVar, novaVar)
+                else:
+                    nouArbre = betaReduccio(esq, dre)
+                    return nouArbre, Pas('β', arbre, nouArbre)
+            else:
+                termeEsq, pas = reduirPas(esq)
+                if pas:
+                    pas.cami = 'e' + pas.cami
+                    return Aplicacio(termeEsq, dre), pas
+                else:
+                    termeDre, pas = reduirPas(dre)
+                    if pas:
+                        pas.cami = 'd' + pas.cami
+                    return Aplicacio(esq, termeDre), pas
 
-    if context.user_data['mostrar_reduccions']:
-        await update.message.reply_text(str_arbreAntic + ' →β→ ' + str_nouArbre)
-    return nouArbre
+        case Variable(_):
+            return arbre, None
 
 
-async def evalArbreSemantic(arbre: Arbre, update: Update, context: ContextTypes.DEFAULT_TYPE):
+def reproduirPas(arbre: Arbre, cami: str):
+    """
+    Torna a fer el pas d'avaluació del redex que es troba al camí donat.
+    Com que l'avaluació és determinista, el resultat és el mateix que el del pas original.
+
+    Paràmetres:
+        arbre (Arbre): L'arbre semàntic abans del pas.
+        cami (str): El camí des de l'arrel fins al redex.
+
+    Retorn:
+        Arbre: L'arbre modificat després del pas.
+        Pas: El pas realitzat.
+    """
+    if not cami:
+        return reduirPas(arbre)
+
+    match arbre:
+        case Abstraccio(cap, cos):
+            nouCos, pas = reproduirPas(cos, cami[1:])
+            return Abstraccio(cap, nouCos), pas
+
+        case Aplicacio(esq, dre):
+            if cami[0] == 'e':
+                termeEsq, pas = reproduirPas(esq, cami[1:])
+                return Aplicacio(termeEsq, dre), pas
+            else:
+                termeDre, pas = reproduirPas(dre, cami[1:])
+                return Aplicacio(esq, termeDre), pas
+
+
+def descriurePas(pas: Pas) -> str:
+    """
+    Retorna la descripció d'un pas d'avaluació tal com es mostra a l'usuari.
+    """
+    str_abans = getArbreSemantic(pas.abans)
+    str_despres = getArbreSemantic(pas.despres)
+
+    if pas.tipus == 'α':
+        return str_abans + ' → α(' + pas.antigaVar + '→' + pas.novaVar + ') → ' + str_despres
+    else:
+        return str_abans + ' →β→ ' + str_despres
+
+
+async def evalArbreSemantic(arbre: Arbre, update: Update, context: ContextTypes.DEFAULT_TYPE, traca: Traca | None = None,
+                            detector: DetectorDivergencia | None = None):
     """
     Avalua un arbre semàntic realitzant les alpha-conversions i beta reduccions necessàries.
 
@@ -314,34 +399,260 @@ async def evalArbreSemantic(arbre: Arbre, update: Update, context: ContextTypes.
         arbre (Arbre): L'arbre semàntic a avaluar.
         update (Update): L'actualització de Telegram per respondre amb els passos d'avaluació.
         context (ContextTypes.DEFAULT_TYPE): El context de l'execució de la conversa de Telegram.
+        traca (Traca): La traça de l'avaluació on es registra el pas, o None si no se'n vol registrar.
+        detector (DetectorDivergencia): El detector que observa les beta reduccions, o None si no se'n vol cap.
 
     Retorn:
         Arbre: L'arbre modificat després de l'avaluació.
         bool: Booleà que indica si s'ha realitzat una alpha-conversió.
         bool: Booleà que indica si s'ha realitzat una beta reducció.
     """
+    nouArbre, pas = reduirPas(arbre)
+    if pas is None:
+        return nouArbre, False, False
+
+    if traca is not None:
+        traca.afegir(pas, nouArbre)
+
+    if pas.tipus == 'α':
+        if context.user_data['mostrar_conversions']:
+            await update.message.reply_text(descriurePas(pas))
+        return nouArbre, True, False
+    else:
+        if detector is not None:
+            detector.observar(nouArbre, pas)
+        if context.user_data['mostrar_reduccions']:
+            await update.message.reply_text(descriurePas(pas))
+        return nouArbre, False, True
+
+# ---- Detecció de cicles i divergència ----
+
+FINESTRA_CICLES = 64  # Nombre de termes recents que es recorden per detectar cicles
+MIDA_DIVERGENCIA = 1000  # Mida a partir de la qual un terme que creix es considera probablement divergent
+REPETICIONS_AUTOREPRODUCCIO = 3  # Contraccions seguides d'un redex que es reprodueix a si mateix
+
+CICLE = 'cicle'
+CREIXEMENT = 'creixement'
+AUTOREPRODUCCIO = 'autoreproduccio'
+
+
+def clauAlpha(arbre: Arbre, lligades: tuple = ()) -> str:
+    """
+    Retorna una representació de l'arbre que és la mateixa per a tots els termes alpha-equivalents.
+    Les variables lligades es representen amb índexs de De Bruijn i les lliures pel seu nom.
+
+    Paràmetres:
+        arbre (Arbre): L'arbre a representar.
+        lligades (tuple): Les variables lligades pels caps de les abstraccions que envolten l'arbre,
+                          de la més interna a la més externa.
+
+    Retorn:
+        str: La representació invariant per alpha-conversió.
+    """
     match arbre:
+        case Variable(val):
+            if val in lligades:
+                return str(lligades.index(val))
+            return val
+
+        case Aplicacio(esq, dre):
+            return '(' + clauAlpha(esq, lligades) + ' ' + clauAlpha(dre, lligades) + ')'
+
         case Abstraccio(cap, cos):
-            nouCos, alphaConv, betaRed = await evalArbreSemantic(cos, update, context)
-            return Abstraccio(cap, nouCos), alphaConv, betaRed
+            return 'λ' + clauAlpha(cos, (cap,) + lligades)
+
+
+def lligadesCami(arbre: Arbre, cami: str) -> tuple:
+    """
+    Retorna les variables lligades pels caps de les abstraccions que es travessen seguint el camí,
+    de la més interna a la més externa, en el format que espera clauAlpha.
+    """
+    lligades = ()
+    for pas in cami:
+        match arbre:
+            case Abstraccio(cap, cos):
+                lligades = (cap,) + lligades
+                arbre = cos
+            case Aplicacio(esq, dre):
+                arbre = esq if pas == 'e' else dre
+    return lligades
+
+
+def mida(arbre: Arbre) -> int:
+    """
+    Retorna el nombre de nodes de l'arbre.
+    """
+    match arbre:
+        case Variable(_):
+            return 1
 
         case Aplicacio(esq, dre):
-            if isinstance(esq, Abstraccio):
-                novaEsq, alphaConv = await alphaConversio(esq, dre, update, context)
-                if alphaConv:
-                    return Aplicacio(novaEsq, dre), True, False
-                else:
-                    return await betaReduccio(esq, dre, arbre, update, context), False, True
+            return 1 + mida(esq) + mida(dre)
+
+        case Abstraccio(_, cos):
+            return 1 + mida(cos)
+
+
+class DetectorDivergencia:
+    """
+    Observa els termes successius d'una avaluació per aturar-la abans d'esgotar el màxim de beta reduccions.
+    Un terme que torna a un terme recent (llevat d'alpha-equivalència) entra segur en un bucle. A més, si les
+    heurístiques estan activades, es considera probablement divergent quan es contreu seguidament un mateix
+    redex que es reprodueix a si mateix (com en les expansions de Y), o quan supera la mida màxima i ha crescut
+    a cada beta reducció de la finestra.
+    """
+
+    def __init__(self, arbre: Arbre | None, midaMaxima: int = MIDA_DIVERGENCIA, heuristiques: bool = True):
+        self.finestra: deque[tuple[str, int]] = deque()
+        self.vistes: dict[str, int] = {}
+        self.resultat = None
+        self.midaMaxima = midaMaxima
+        self.heuristiques = heuristiques
+        self.ultimRedex = None  # Camí i clau (en el seu context) de l'últim redex contret
+        self.repeticions = 0
+        if arbre is not None:
+            self.afegir(clauAlpha(arbre), mida(arbre))
+
+    def copia(self, midaMaxima: int = MIDA_DIVERGENCIA, heuristiques: bool = True) -> DetectorDivergencia:
+        """
+        Retorna una còpia independent del detector amb la configuració donada. Els resultats de les
+        heurístiques no es copien, perquè depenen de la configuració de qui els va obtenir.
+        """
+        detector = DetectorDivergencia(None, midaMaxima, heuristiques)
+        detector.finestra = deque(self.finestra)
+        detector.vistes = dict(self.vistes)
+        detector.ultimRedex = self.ultimRedex
+        detector.repeticions = self.repeticions
+        if self.resultat == CICLE:
+            detector.resultat = CICLE
+        return detector
+
+    def afegir(self, clau: str, n: int) -> None:
+        self.finestra.append((clau, n))
+        self.vistes[clau] = self.vistes.get(clau, 0) + 1
+        if len(self.finestra) > FINESTRA_CICLES:
+            clauAntiga, _ = self.finestra.popleft()
+            self.vistes[clauAntiga] -= 1
+            if not self.vistes[clauAntiga]:
+                del self.vistes[clauAntiga]
+
+    def creixementSostingut(self, n: int) -> bool:
+        """
+        Comprova si la mida del terme ha crescut a cada beta reducció de la finestra fins a arribar a 'n'.
+        """
+        if len(self.finestra) < FINESTRA_CICLES:
+            return False
+        mides = [m for _, m in self.finestra] + [n]
+        return all(m1 < m2 for m1, m2 in zip(mides, mides[1:]))
+
+    def observar(self, arbre: Arbre, pas: Pas) -> str | None:
+        """
+        Registra el terme resultant d'una beta reducció.
+
+        Paràmetres:
+            arbre (Arbre): El terme després de la beta reducció.
+            pas (Pas): La beta reducció realitzada.
+
+        Retorn:
+            str: CICLE si el terme ja s'ha vist recentment, AUTOREPRODUCCIO si s'ha contret seguidament un redex
+                 que es reprodueix a si mateix, CREIXEMENT si supera la mida màxima després de créixer a cada pas
+                 de la finestra, o None si no es detecta res.
+        """
+        clau = clauAlpha(arbre)
+        n = mida(arbre)
+
+        if clau in self.vistes:
+            self.resultat = CICLE
+        elif self.heuristiques:
+            # El redex es reprodueix a si mateix si el següent redex contret és dins del resultat de l'anterior
+            # (el seu camí l'allarga) i és el mateix terme en el mateix context de variables lligades
+            clauRedex = clauAlpha(pas.abans, lligadesCami(arbre, pas.cami))
+            if self.ultimRedex is not None:
+                camiAnterior, clauAnterior = self.ultimRedex
+                reproduit = len(pas.cami) > len(camiAnterior) and pas.cami.startswith(camiAnterior) \
+                    and clauRedex == clauAnterior
             else:
-                termeEsq, alphaConvEsq, betaRedEsq = await evalArbreSemantic(esq, update, context)
-                if alphaConvEsq or betaRedEsq:
-                    return Aplicacio(termeEsq, dre), alphaConvEsq, betaRedEsq
-                else:
-                    termeDre, alphaConvDre, betaRedDre = await evalArbreSemantic(dre, update, context)
-                    return Aplicacio(esq, termeDre), alphaConvDre, betaRedDre
+                reproduit = False
+            self.repeticions = self.repeticions + 1 if reproduit else 1
+            self.ultimRedex = (pas.cami, clauRedex)
+
+            if self.repeticions >= REPETICIONS_AUTOREPRODUCCIO:
+                self.resultat = AUTOREPRODUCCIO
+            elif n > self.midaMaxima and self.creixementSostingut(n):
+                self.resultat = CREIXEMENT
+
+        self.afegir(clau, n)
+        return self.resultat
+
+
+# ---- Traces de les avaluacions ----
+
+MAX_MEMORIA_TRACES = 1_000_000  # Memòria aproximada (en bytes) de les traces que es desen per usuari
+MAX_TRACES = 10  # Nombre màxim d'avaluacions de les quals es desa la traça per usuari
+MAX_PASSOS_TRACE = 20  # Nombre màxim de passos que es mostren amb una comanda /trace
+MEMORIA_NODE = 56  # Memòria aproximada d'un node de l'arbre
+MEMORIA_PAS = 120  # Memòria aproximada d'un pas de la traça, sense comptar el camí
+PASSOS_PUNT_CONTROL = 50  # Cada quants passos es desa el terme sencer per no haver de reproduir des de l'inici
+
+
+@dataclass
+class Traca:
+    """
+    Registre compacte d'una avaluació: el terme inicial i, per a cada pas, el camí fins al redex, el tipus
+    de pas i el canvi de variable de les alpha-conversions. Qualsevol terme intermedi es pot reconstruir
+    reproduint els passos des del punt de control anterior més proper. Quan la traça arriba al límit de
+    memòria deixa de registrar passos i queda retallada.
+    """
+    inicial: Arbre
+    passos: list[tuple[str, str, str | None, str | None]] = field(default_factory=list)
+    punts: dict[int, Arbre] = field(default_factory=dict)  # Número de pas → terme després d'aquell pas
+    memoria: int = 0
+    retallada: bool = False
+
+    def __post_init__(self):
+        self.memoria = mida(self.inicial) * MEMORIA_NODE
+        self.punts[0] = self.inicial
+
+    def afegir(self, pas: Pas, arbre: Arbre) -> None:
+        """
+        Registra un pas i, cada PASSOS_PUNT_CONTROL passos, el terme resultant com a punt de control.
+
+        Paràmetres:
+            pas (Pas): El pas realitzat.
+            arbre (Arbre): El terme sencer després del pas.
+        """
+        if self.retallada:
+            return
+
+        cost = MEMORIA_PAS + len(pas.cami)
+        puntControl = (len(self.passos) + 1) % PASSOS_PUNT_CONTROL == 0
+        if puntControl:
+            cost += mida(arbre) * MEMORIA_NODE
+        if self.memoria + cost > MAX_MEMORIA_TRACES:
+            self.retallada = True
+            return
+
+        self.passos.append((pas.cami, pas.tipus, pas.antigaVar, pas.novaVar))
+        if puntControl:
+            self.punts[len(self.passos)] = arbre
+        self.memoria += cost
+
+
+def desarTraca(traca: Traca, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Desa la traça com a l'última avaluació de l'usuari i descarta les més antigues
+    fins que la memòria de les traces desades no supera el límit per usuari.
+
+    Paràmetres:
+        traca (Traca): La traça a desar.
+        context (ContextTypes.DEFAULT_TYPE): El context de l'execució de la conversa de Telegram.
+    """
+    traces = context.user_data['traces']
+    traces.append(traca)
+    # Cada traça per si sola ja està limitada a MAX_MEMORIA_TRACES
+    while len(traces) > 1 and sum(t.memoria for t in traces) > MAX_MEMORIA_TRACES:
+        traces.popleft()
 
-        case Variable(_):
-            return arbre, False, False
 
 # ---- Tasca 7: representació gràfica dels arbres ----
 
@@ -400,13 +711,264 @@ async def printImatgeArbreSemantic(arbreSemantic: Arbre, update: Update, context
     createNodeRec(arbreSemantic)
 
     # Carreguem i enviem la imatge
+    # Llegim el fitxer abans de cedir el control perquè una altra avaluació no el sobreescrigui
     graph.write_png('output.png')
-    photo_file = open('output.png', 'rb')
-    await update.message.reply_photo(photo_file)
+    with open('output.png', 'rb') as photo_file:
+        photo = photo_file.read()
+    await update.message.reply_photo(photo)
+
+# ---- Caches d'anàlisi i de formes normals ----
+
+MIDA_CACHE_ANALISI = 256
+MIDA_CACHE_FORMES_NORMALS = 512
+MIDA_CACHE_PROGRES = 128
+
+
+@functools.lru_cache(maxsize=MIDA_CACHE_ANALISI)
+def analitzarSintaxi(msg: str):
+    """
+    Analitza sintàcticament una expressió. El resultat no depèn de les macros de l'usuari,
+    de manera que es pot compartir entre tots els usuaris.
+
+    Paràmetres:
+        msg (str): L'expressió a analitzar.
+
+    Retorn:
+        ParserRuleContext: L'arbre sintàctic de l'expressió.
+        int: El nombre d'errors de sintaxi.
+    """
+    input_stream = InputStream(msg)
+    lexer = lcLexer(input_stream)
+    token_stream = CommonTokenStream(lexer)
+    parser = lcParser(token_stream)
+    tree = parser.root()
+    return tree, parser.getNumberOfSyntaxErrors()
+
+
+class CacheLRU:
+    """
+    Cache de mida acotada que descarta l'entrada utilitzada fa més temps quan s'omple.
+    """
+
+    def __init__(self, mida: int):
+        self.mida = mida
+        self.entrades = OrderedDict()
+
+    def obtenir(self, clau):
+        if clau not in self.entrades:
+            return None
+        self.entrades.move_to_end(clau)
+        return self.entrades[clau]
+
+    def desar(self, clau, valor) -> None:
+        self.entrades[clau] = valor
+        self.entrades.move_to_end(clau)
+        if len(self.entrades) > self.mida:
+            self.entrades.popitem(last=False)
+
+    def eliminar(self, clau) -> None:
+        self.entrades.pop(clau, None)
+
+
+# Terme inicial → (forma normal, n. alpha conversions, n. beta reduccions)
+cacheFormesNormals = CacheLRU(MIDA_CACHE_FORMES_NORMALS)
+# Terme inicial → (terme actual, n. alpha conversions, n. beta reduccions, detector de divergència)
+# de les avaluacions inline a mitges
+cacheProgres = CacheLRU(MIDA_CACHE_PROGRES)
+
+def desarProgres(clau: str, progres: tuple) -> None:
+    """
+    Desa el progrés d'una avaluació inline a mitges, llevat que ja n'hi hagi un de més avançat
+    (per exemple, el d'una altra consulta per la mateixa expressió).
+
+    Paràmetres:
+        clau (str): El terme inicial de l'avaluació.
+        progres (tuple): El terme actual, el nombre d'alpha conversions, el de beta reduccions i el detector.
+    """
+    _, nAlpha, nBeta, _ = progres
+    desat = cacheProgres.obtenir(clau)
+    if desat is None or desat[1] + desat[2] < nAlpha + nBeta:
+        cacheProgres.desar(clau, progres)
+
+# ---- Planificador d'avaluacions ----
+
+logger = logging.getLogger(__name__)
+
+MAX_AVALUACIONS_SIMULTANIES = 4
+MAX_CUA_USUARI = 3
+
+
+@dataclass
+class Avaluacio:
+    usuari: int
+    treball: Callable[[Avaluacio], Awaitable[None]]
+    encuada: float = field(default_factory=time.monotonic)
+    cancellada: bool = False
+
+
+class PlanificadorAvaluacions:
+    """
+    Planificador que executa com a molt una avaluació activa per usuari, amb una cua acotada
+    d'avaluacions pendents per usuari. Els usuaris són servits per torns (round-robin), de manera
+    que un usuari amb moltes peticions seguides no pot monopolitzar el bot.
+    """
+
+    def __init__(self, maxSimultanies: int = MAX_AVALUACIONS_SIMULTANIES, maxCua: int = MAX_CUA_USUARI):
+        self.maxSimultanies = maxSimultanies
+        self.maxCua = maxCua
+        self.cues: dict[int, deque[Avaluacio]] = {}
+        self.torn: deque[int] = deque()  # Usuaris amb avaluacions pendents, en ordre de servei
+        self.actives: dict[int, Avaluacio] = {}
+        self.esperes: deque[float] = deque(maxlen=50)  # Temps d'espera de les últimes avaluacions
+        self.tasques: dict[int, asyncio.Task] = {}  # Referències a les tasques en curs perquè no es recullin
+
+    def encuar(self, usuari: int, treball: Callable[[Avaluacio], Awaitable[None]]) -> Avaluacio | None:
+        """
+        Afegeix una avaluació a la cua de l'usuari.
+
+        Paràmetres:
+            usuari (int): L'identificador de l'usuari.
+            treball (Callable): La corutina que realitza l'avaluació. Rep l'objecte Avaluacio.
+
+        Retorn:
+            Avaluacio: L'avaluació encuada, o None si la cua de l'usuari és plena.
+        """
+        cua = self.cues.setdefault(usuari, deque())
+        if len(cua) >= self.maxCua:
+            logger.info("Cua plena per a l'usuari %s (%d pendents)", usuari, len(cua))
+            return None
+
+        avaluacio = Avaluacio(usuari, treball)
+        cua.append(avaluacio)
+        if usuari not in self.actives and usuari not in self.torn:
+            self.torn.append(usuari)
+        logger.info("Avaluació encuada per a l'usuari %s (cua usuari: %d, pendents totals: %d)",
+                    usuari, len(cua), self.pendents())
+
+        self.despatxar()
+        return avaluacio
+
+    def cancellar(self, usuari: int) -> tuple[bool, int]:
+        """
+        Cancel·la l'avaluació activa de l'usuari i descarta les que té pendents.
+        L'avaluació activa s'atura al següent pas de reducció.
+
+        Paràmetres:
+            usuari (int): L'identificador de l'usuari.
+
+        Retorn:
+            bool: Cert si hi havia una avaluació activa.
+            int: El nombre d'avaluacions pendents descartades.
+        """
+        activa = self.actives.get(usuari)
+        if activa:
+            activa.cancellada = True
+
+        cua = self.cues.pop(usuari, deque())
+        if usuari in self.torn:
+            self.torn.remove(usuari)
+        return activa is not None, len(cua)
+
+    def despatxar(self) -> None:
+        """
+        Inicia avaluacions pendents mentre hi hagi capacitat, agafant els usuaris per torns.
+        """
+        while self.torn and len(self.actives) < self.maxSimultanies:
+            usuari = self.torn.popleft()
+            avaluacio = self.cues[usuari].popleft()
+            if not self.cues[usuari]:
+                del self.cues[usuari]
+
+            espera = time.monotonic() - avaluacio.encuada
+            self.esperes.append(espera)
+            self.actives[usuari] = avaluacio
+            logger.info("Avaluació iniciada per a l'usuari %s després d'esperar %.2fs", usuari, espera)
+            self.tasques[usuari] = asyncio.create_task(self.executar(avaluacio))
+
+    async def executar(self, avaluacio: Avaluacio) -> None:
+        """
+        Executa una avaluació i, quan acaba, torna a posar l'usuari al final del torn si té més pendents.
+
+        Paràmetres:
+            avaluacio (Avaluacio): L'avaluació a executar.
+        """
+        try:
+            await avaluacio.treball(avaluacio)
+        except asyncio.CancelledError:
+            logger.warning("S'ha interromput l'avaluació de l'usuari %s", avaluacio.usuari)
+            raise
+        except Exception:
+            logger.exception("Error avaluant l'expressió de l'usuari %s", avaluacio.usuari)
+        finally:
+            del self.actives[avaluacio.usuari]
+            del self.tasques[avaluacio.usuari]
+            if avaluacio.usuari in self.cues:
+                self.torn.append(avaluacio.usuari)
+            self.despatxar()
+
+    def posicio(self, usuari: int) -> int:
+        """
+        Retorna quantes avaluacions pendents començaran abans que l'última avaluació encuada de l'usuari,
+        simulant els torns entre usuaris. Els usuaris amb una avaluació en curs es consideren al final del torn.
+
+        Paràmetres:
+            usuari (int): L'identificador de l'usuari.
+
+        Retorn:
+            int: La posició (començant per 1) de l'avaluació a la cua global, o 0 si l'usuari no té pendents.
+        """
+        ordre = list(self.torn) + [u for u in self.actives if u in self.cues and u not in self.torn]
+        restants = {u: len(self.cues[u]) for u in ordre}
+        posicio = 0
+        while restants.get(usuari):
+            for u in ordre:
+                if restants[u]:
+                    restants[u] -= 1
+                    posicio += 1
+                    if u == usuari and not restants[u]:
+                        return posicio
+        return posicio
+
+    async def aturar(self, temps: float = 10) -> None:
+        """
+        Atura el planificador: descarta les avaluacions pendents, demana a les que estan en curs que s'aturin
+        al següent pas i n'espera la finalització. Les que no acaben a temps es cancel·len.
+
+        Paràmetres:
+            temps (float): El temps màxim (en segons) que s'espera les avaluacions en curs.
+        """
+        self.cues.clear()
+        self.torn.clear()
+        for avaluacio in self.actives.values():
+            avaluacio.cancellada = True
+
+        if self.tasques:
+            _, pendents = await asyncio.wait(list(self.tasques.values()), timeout=temps)
+            for tasca in pendents:
+                tasca.cancel()
+            await asyncio.gather(*pendents, return_exceptions=True)
+
+    def pendents(self, usuari: int | None = None) -> int:
+        """
+        Retorna el nombre d'avaluacions pendents d'un usuari, o de tots si no se n'especifica cap.
+        """
+        if usuari is not None:
+            return len(self.cues.get(usuari, ()))
+        return sum(len(cua) for cua in self.cues.values())
+
+    def esperaMitjana(self) -> float:
+        """
+        Retorna el temps d'espera mitjà (en segons) de les últimes avaluacions iniciades.
+        """
+        if not self.esperes:
+            return 0.0
+        return sum(self.esperes) / len(self.esperes)
+
+
+planificador = PlanificadorAvaluacions()
 
 # ---- Tasca 6: AChurch a Telegram ----
 
-TOKEN = open('token.txt').read().strip()
 """
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -429,6 +991,9 @@ def initialize(context: ContextTypes.DEFAULT_TYPE) -> None:
     context.user_data['mostrar_estadistiques'] = True
     context.user_data['mostrar_imatges'] = True
     context.user_data['macros_importades'] = False
+    context.user_data['deteccio_divergencia'] = True
+    context.user_data['mida_divergencia'] = MIDA_DIVERGENCIA
+    context.user_data['traces'] = deque(maxlen=MAX_TRACES)
 
     # Inicialitzacions del context.bot_data
     if not 'estat' in context.bot_data:
@@ -485,7 +1050,10 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "/config: Et mostro tota la meva configuració actual.\n"
         '/set: Et permet modificar la meva configuració actual.\n'
         '         Escriu /set per veure totes les opcions disponibles.\n'
-        'Expressió λ-càlcul.')
+        "/cancel: Aturo l'avaluació en curs i descarto les pendents.\n"
+        "/trace <des_de> <fins_a> [avaluació]: Et mostro els passos d'una avaluació (per defecte, l'última).\n"
+        'Expressió λ-càlcul.\n'
+        "@LambdaCalculBot <expressió>: Avaluo l'expressió des de qualsevol xat (mode inline).")
 
 
 async def macros(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -535,13 +1103,32 @@ async def config(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         '  - Mostra/Amaga les estadístiques de cada avaluació.\n'
     message += '<b>mostrar_imatges</b> = ' + str(context.user_data['mostrar_imatges']) + \
         '  - Mostra/Amaga les imatges de cada avaluació.\n'
+    message += '<b>deteccio_divergencia</b> = ' + str(context.user_data['deteccio_divergencia']) + \
+        '  - Atura les avaluacions que probablement no acaben.\n'
+    message += '<b>mida_divergencia</b> = ' + str(context.user_data['mida_divergencia']) + \
+        '  - Mida a partir de la qual un terme que ha crescut a cada una de les últimes ' + str(FINESTRA_CICLES) + \
+        ' beta reduccions es considera divergent (cal un max_reduccions més gran).\n'
     message += '<b>importar_macros</b> = ' + str(context.user_data['macros_importades']) + \
         '  - Importa un conjunt de macros per defecte.\n'
     estat_html = html.escape(context.bot_data['estat'])
     message += '<b>estat</b> = ' + estat_html + \
-        '  - Defineix el meu estat que és compartit per tots els usuaris.'
+        '  - Defineix el meu estat que és compartit per tots els usuaris.\n\n'
 
-    await update.message.reply_html(message)
+    usuari = update.effective_user.id
+    message += '<b>Cua d\'avaluacions</b>\n'
+    message += '   Avaluació en curs: ' + ('si' if usuari in planificador.actives else 'no') + '\n'
+    message += '   Pendents teves: ' + str(planificador.pendents(usuari)) + ' (màxim ' + str(planificador.maxCua) + ')\n'
+    message += '   Pendents totals: ' + str(planificador.pendents()) + '\n'
+    message += '   Espera mitjana: ' + '{:.2f}'.format(planificador.esperaMitjana()) + 's\n\n'
+
+    traces = context.user_data['traces']
+    message += '<b>Traces desades</b> = ' + str(len(traces)) + ' (' + str(sum(t.memoria for t in traces) // 1024) + \
+        ' KB de ' + str(MAX_MEMORIA_TRACES // 1024) + ' KB, màxim ' + str(MAX_TRACES) + ')  - Consulta els passos amb /trace &lt;des_de&gt; &lt;fins_a&gt; [avaluació].'
+    for n, traca in enumerate(reversed(traces), 1):
+        message += '\n   ' + str(n) + '. ' + html.escape(retallar(getArbreSemantic(traca.inicial), 60)) + \
+            ' (' + str(len(traca.passos)) + ' passos' + (', retallada' if traca.retallada else '') + ')'
+
+    await update.message.reply_html(retallar(message, MAX_LLARGADA_MISSATGE))
 
 
 async def set(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -565,6 +1152,25 @@ async def set(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             context.user_data[conf] = n
             await update.message.reply_text("El nombre màxim de beta reduccions s'ha establert a " + str(n) + '.')
 
+        elif conf == 'mida_divergencia':
+            n = int(context.args[1])
+            if n < 1:
+                await update.message.reply_html('<b>ERROR:</b> La mida de divergència ha de ser major a 0.')
+                return
+            context.user_data[conf] = n
+            await update.message.reply_text("La mida de divergència s'ha establert a " + str(n) + ' nodes.')
+
+        elif conf == 'deteccio_divergencia':
+            b = context.args[1]
+            if b == 'si':
+                context.user_data[conf] = True
+                await update.message.reply_text("S'aturaran les avaluacions que probablement no acaben.")
+            elif b == 'no':
+                context.user_data[conf] = False
+                await update.message.reply_text("Només s'aturaran les avaluacions que entren en un bucle.")
+            else:
+                await update.message.reply_html('<b>Usage:</b> /set ' + conf + ' {si/no}')
+
         elif conf in ['mostrar_conversions', 'mostrar_reduccions', 'mostrar_estadistiques', 'mostrar_imatges']:
             b = context.args[1]
             conf_mapping = {
@@ -598,6 +1204,8 @@ async def set(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                                         '   /set mostrar_reduccions {si/no}\n'
                                         '   /set mostrar_estadistiques {si/no}\n'
                                         '   /set mostrar_imatges {si/no}\n'
+                                        '   /set deteccio_divergencia {si/no}\n'
+                                        '   /set mida_divergencia &lt;num_nodes&gt;\n'
                                         "   /set estat &lt;nou_estat (visible per la resta d'usuaris)&gt;")
 
 
@@ -621,11 +1229,7 @@ async def importar_macros(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
         visitor = TreeVisitor(context.user_data['macros'])
         for macro in macros_importades:
-            input_stream = InputStream(macro)
-            lexer = lcLexer(input_stream)
-            token_stream = CommonTokenStream(lexer)
-            parser = lcParser(token_stream)
-            tree = parser.root()
+            tree, _ = analitzarSintaxi(macro)
             visitor.visit(tree)
 
         context.user_data['macros_importades'] = True
@@ -634,9 +1238,93 @@ async def importar_macros(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text('Ja vas importar les macros i les tens disponibles a /macros.')
 
 
+async def avaluar(arbreSemantic: Arbre, update: Update, context: ContextTypes.DEFAULT_TYPE, avaluacio: Avaluacio) -> None:
+    """
+    Avalua un arbre semàntic fins a la forma normal o fins al màxim de beta reduccions, i mostra el resultat.
+    S'executa des del planificador i s'atura al següent pas si l'usuari cancel·la l'avaluació.
+
+    Paràmetres:
+        arbreSemantic (Arbre): L'arbre semàntic a avaluar.
+        update (Update): L'objecte Update de Telegram que representa el missatge de l'usuari.
+        context (ContextTypes.DEFAULT_TYPE): El context de l'execució de la conversa de Telegram.
+        avaluacio (Avaluacio): L'avaluació del planificador associada a aquesta execució.
+    """
+    str_arbre = getArbreSemantic(arbreSemantic)
+    await update.message.reply_text(str_arbre)
+
+    if context.user_data['mostrar_imatges']:
+        await printImatgeArbreSemantic(arbreSemantic, update, context)
+
+    maxBetaReduccions = context.user_data['max_reduccions']
+    nAlpha, nBeta = 0, 0
+    nouArbre, alphaConv, betaRed = arbreSemantic, True, True
+    detector = DetectorDivergencia(arbreSemantic, context.user_data['mida_divergencia'],
+                                   context.user_data['deteccio_divergencia'])
+    traca = Traca(arbreSemantic)
+
+    while (alphaConv or betaRed) and maxBetaReduccions > 0 and detector.resultat is None:
+        # Cedim el control entre passos perquè es pugui processar un /cancel
+        await asyncio.sleep(0)
+        if avaluacio.cancellada:
+            break
+
+        nouArbre, alphaConv, betaRed = await evalArbreSemantic(nouArbre, update, context, traca, detector)
+        if alphaConv:
+            nAlpha += 1
+        elif betaRed:
+            nBeta += 1
+            maxBetaReduccions -= 1
+
+    desarTraca(traca, context)
+
+    # Si hem arribat a la forma normal la desem perquè les consultes inline la puguin reutilitzar
+    if not (alphaConv or betaRed):
+        cacheFormesNormals.desar(str_arbre, (nouArbre, nAlpha, nBeta))
+
+    if avaluacio.cancellada:
+        await update.message.reply_text("S'ha cancel·lat l'avaluació després de " + str(nBeta) + ' beta reduccions.')
+        if not (nAlpha or nBeta):
+            return
+        await update.message.reply_text('Arbre resultant després de ' + str(nBeta) + ' beta reduccions:')
+
+    elif detector.resultat == CICLE:
+        await update.message.reply_text('...')
+        await update.message.reply_html('<b>El terme entra en un bucle:</b> després de ' + str(nBeta) +
+                                        " beta reduccions torna a un terme que ja havia aparegut (llevat d'alpha-equivalència).")
+        await update.message.reply_text('Arbre resultant després de ' + str(nBeta) + ' beta reduccions:')
+
+    elif detector.resultat in [CREIXEMENT, AUTOREPRODUCCIO]:
+        await update.message.reply_text('...')
+        if detector.resultat == CREIXEMENT:
+            await update.message.reply_html('<b>Probablement divergent:</b> després de ' + str(nBeta) +
+                                            ' beta reduccions el terme té ' + str(mida(nouArbre)) +
+                                            ' nodes i ha crescut a cada una de les últimes ' + str(FINESTRA_CICLES) + '.')
+        else:
+            await update.message.reply_html('<b>Probablement divergent:</b> després de ' + str(nBeta) +
+                                            ' beta reduccions, el mateix redex es reprodueix a si mateix a cada pas.')
+        await update.message.reply_html('Utilitza la comanda <code>/set deteccio_divergencia no</code> per desactivar aquesta detecció.')
+        await update.message.reply_text('Arbre resultant després de ' + str(nBeta) + ' beta reduccions:')
+
+    elif maxBetaReduccions <= 0:
+        await update.message.reply_text('...')
+        await update.message.reply_html("S'ha arribat al màxim de beta reduccions (" + str(nBeta) + ').')
+        await update.message.reply_html('Utilitza la comanda <code>/set max_reduccions &lt;num_reduccions&gt;</code> per incrementar el límit de beta reduccions.')
+        await update.message.reply_text('Arbre resultant després de ' + str(nBeta) + ' beta reduccions:')
+
+    if nAlpha or nBeta:
+        str_nouArbre = getArbreSemantic(nouArbre)
+        await update.message.reply_html('<b>' + str_nouArbre + '</b>')
+
+        if context.user_data['mostrar_imatges']:
+            await printImatgeArbreSemantic(nouArbre, update, context)
+
+        if context.user_data['mostrar_estadistiques']:
+            await update.message.reply_html("<b>Estadístiques:</b>\n   N. alpha conversions: " + str(nAlpha) + '\n   N. beta reduccions: ' + str(nBeta))
+
+
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Processa i avalua una expressió en lambda càlcul i retorna el resultat.
+    Processa una expressió en lambda càlcul i n'encua l'avaluació al planificador.
 
     Paràmetres:
         update (Update): L'objecte Update de Telegram que representa el missatge de l'usuari.
@@ -647,14 +1335,9 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     # Configuració
     visitor = TreeVisitor(context.user_data['macros'])
-    msg = update.message.text
-    input_stream = InputStream(msg)
-    lexer = lcLexer(input_stream)
-    token_stream = CommonTokenStream(lexer)
-    parser = lcParser(token_stream)
-    tree = parser.root()
+    tree, nErrors = analitzarSintaxi(update.message.text)
 
-    if parser.getNumberOfSyntaxErrors() == 0:
+    if nErrors == 0:
         arbreSemantic = visitor.visit(tree)
 
         # Si hem fet una definició no cal avaluar l'arbre
@@ -662,46 +1345,211 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await update.message.reply_text('Macro definida correctament.')
             return
 
-        str_arbre = getArbreSemantic(arbreSemantic)
-        await update.message.reply_text(str_arbre)
+        usuari = update.effective_user.id
+        avaluacio = planificador.encuar(usuari, lambda avaluacio: avaluar(arbreSemantic, update, context, avaluacio))
+        if avaluacio is None:
+            await update.message.reply_html("<b>ERROR:</b> Ja tens " + str(planificador.maxCua) + ' avaluacions en espera. '
+                                            'Espera que acabin o utilitza /cancel per aturar-les.')
+        elif planificador.actives.get(usuari) is not avaluacio:
+            await update.message.reply_text("L'expressió està a la cua i s'avaluarà quan sigui el teu torn "
+                                            '(posició ' + str(planificador.posicio(usuari)) + ').')
+    else:
+        await update.message.reply_html('<b>ERROR DE SINTAXIS\n</b>Hi ha ' + str(nErrors) + " errors de sintaxi. No s'ha pogut avaluar l'expressió.")
 
-        if context.user_data['mostrar_imatges']:
-            await printImatgeArbreSemantic(arbreSemantic, update, context)
 
-        maxBetaReduccions = context.user_data['max_reduccions']
-        nAlpha, nBeta = 0, 0
-        nouArbre, alphaConv, betaRed = await evalArbreSemantic(arbreSemantic, update, context)
-        if alphaConv:
-            nAlpha += 1
-        elif betaRed:
-            nBeta += 1
-            maxBetaReduccions -= 1
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Respon a la comanda /cancel de l'usuari aturant l'avaluació en curs i descartant les pendents.
+
+    Paràmetres:
+        update (Update): L'objecte Update de Telegram que representa el missatge de l'usuari.
+        context (ContextTypes.DEFAULT_TYPE): El context de l'execució de la conversa de Telegram.
+    """
+    activa, descartades = planificador.cancellar(update.effective_user.id)
+    if not activa and not descartades:
+        await update.message.reply_text('No tens cap avaluació en curs.')
+        return
+
+    message = ''
+    if activa:
+        message += "S'aturarà l'avaluació en curs.\n"
+    if descartades:
+        message += "S'han descartat " + str(descartades) + ' avaluacions pendents.'
+    await update.message.reply_text(message.strip())
+
+
+async def trace(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Respon a la comanda /trace de l'usuari mostrant els passos indicats d'una de les seves últimes avaluacions
+    (per defecte, l'última). Els termes es reconstrueixen a partir de la traça, sense tornar a avaluar l'expressió.
+
+    Paràmetres:
+        update (Update): L'objecte Update de Telegram que representa el missatge de l'usuari.
+        context (ContextTypes.DEFAULT_TYPE): El context de l'execució de la conversa de Telegram.
+    """
+    if not 'macros' in context.user_data:
+        initialize(context)
+
+    traces = context.user_data['traces']
+    if not traces:
+        await update.message.reply_text('Encara no has avaluat cap expressió.')
+        return
+
+    try:
+        n = int(context.args[2]) if len(context.args) > 2 else 1
+        if not 1 <= n <= len(traces):
+            raise ValueError()
+        traca = traces[-n]
+        nPassos = len(traca.passos)
+        desDe, finsA = int(context.args[0]), int(context.args[1])
+        if not 0 <= desDe <= finsA <= nPassos:
+            raise ValueError()
+    except (IndexError, ValueError):
+        message = '<b>Usage:</b> /trace &lt;des_de&gt; &lt;fins_a&gt; [avaluació]\n' \
+                  'Tens ' + str(len(traces)) + ' avaluacions desades (1 és la més recent, consulta-les a /config).\n'
+        traca = traces[-1]
+        message += "L'última avaluació té " + str(len(traca.passos)) + ' passos (de 0 a ' + str(len(traca.passos)) + ').'
+        await update.message.reply_html(message)
+        return
+
+    if finsA - desDe > MAX_PASSOS_TRACE:
+        await update.message.reply_html('<b>ERROR:</b> Com a molt es poden mostrar ' + str(MAX_PASSOS_TRACE) + ' passos alhora.')
+        return
+
+    # Comencem pel punt de control més proper anterior a 'desDe'
+    inici = max(i for i in traca.punts if i <= desDe)
+    arbre = traca.punts[inici]
+    for i in range(inici, finsA):
+        # Cedim el control entre passos perquè la reproducció no bloquegi el bot
+        await asyncio.sleep(0)
+        if i == desDe:
+            await update.message.reply_text(retallar('Pas ' + str(i) + ': ' + getArbreSemantic(arbre), MAX_LLARGADA_MISSATGE))
+        cami, _, _, _ = traca.passos[i]
+        arbre, pas = reproduirPas(arbre, cami)
+        if i >= desDe:
+            await update.message.reply_text(retallar('Pas ' + str(i + 1) + ': ' + descriurePas(pas), MAX_LLARGADA_MISSATGE))
+
+    # Retallem abans d'escapar perquè el tall no parteixi cap entitat HTML, fins que el text escapat hi cap
+    prefix = 'Pas ' + str(finsA) + ': '
+    maxim = MAX_LLARGADA_MISSATGE - len(prefix) - len('<b></b>')
+    str_arbre, llargada = getArbreSemantic(arbre), maxim
+    while len(html.escape(retallar(str_arbre, llargada))) > maxim:
+        # Cada caràcter escapat ocupa com a molt 5 caràcters ('&amp;')
+        llargada -= (len(html.escape(retallar(str_arbre, llargada))) - maxim + 4) // 5
+    await update.message.reply_html(prefix + '<b>' + html.escape(retallar(str_arbre, llargada)) + '</b>')
+    if finsA == nPassos and traca.retallada:
+        await update.message.reply_text("La traça d'aquesta avaluació s'ha retallat en aquest pas pel límit de memòria.")
+
+
+PRESSUPOST_INLINE = 0.5  # Temps màxim (en segons) per respondre una consulta inline
+MAX_LLARGADA_MISSATGE = 4096  # Llargada màxima d'un missatge de Telegram
+MAX_LLARGADA_TITOL = 256
+
+
+def retallar(text: str, llargada: int) -> str:
+    """
+    Retorna el text retallat a la llargada donada, acabat en '…' si s'ha hagut de retallar.
+    """
+    if len(text) <= llargada:
+        return text
+    return text[:llargada - 1] + '…'
+
+
+async def inline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Respon a les consultes inline avaluant l'expressió dins d'un pressupost de temps fix.
+    Si l'avaluació no acaba dins del pressupost, es respon amb el resultat parcial i el progrés es desa
+    perquè la següent consulta amb la mateixa expressió continuï on s'havia quedat. Les consultes que
+    queden obsoletes perquè l'usuari ha continuat escrivint s'abandonen sense respondre.
 
-        while (alphaConv or betaRed) and maxBetaReduccions > 0:
-            nouArbre, alphaConv, betaRed = await evalArbreSemantic(nouArbre, update, context)
-            if alphaConv:
-                nAlpha += 1
-            elif betaRed:
-                nBeta += 1
-                maxBetaReduccions -= 1
-
-        if maxBetaReduccions <= 0:
-            await update.message.reply_text('...')
-            await update.message.reply_html("S'ha arribat al màxim de beta reduccions (" + str(nBeta) + ').')
-            await update.message.reply_html('Utilitza la comanda <code>/set max_reduccions &lt;num_reduccions&gt;</code> per incrementar el límit de beta reduccions.')
-            await update.message.reply_text('Arbre resultant després de ' + str(nBeta) + ' beta reduccions:')
-
-        if nAlpha or nBeta:
-            str_nouArbre = getArbreSemantic(nouArbre)
-            await update.message.reply_html('<b>' + str_nouArbre + '</b>')
-
-            if context.user_data['mostrar_imatges']:
-                await printImatgeArbreSemantic(nouArbre, update, context)
-
-            if context.user_data['mostrar_estadistiques']:
-                await update.message.reply_html("<b>Estadístiques:</b>\n   N. alpha conversions: " + str(nAlpha) + '\n   N. beta reduccions: ' + str(nBeta))
+    Paràmetres:
+        update (Update): L'objecte Update de Telegram que representa la consulta inline.
+        context (ContextTypes.DEFAULT_TYPE): El context de l'execució de la conversa de Telegram.
+    """
+    if not 'macros' in context.user_data:
+        initialize(context)
+
+    inici = time.monotonic()
+    query = update.inline_query
+    context.user_data['consulta_inline'] = query.id
+
+    msg = query.query.strip()
+    if not msg:
+        return
+
+    # Mentre l'usuari escriu l'expressió sovint encara no és correcta: no responem
+    tree, nErrors = analitzarSintaxi(msg)
+    if nErrors:
+        return
+
+    try:
+        # Fem servir una còpia de les macros perquè una consulta inline no defineixi macros
+        arbreSemantic = TreeVisitor(dict(context.user_data['macros'])).visit(tree)
+    except KeyError:
+        return
+    if arbreSemantic == None:
+        return
+
+    maxBetaReduccions = context.user_data['max_reduccions']
+    str_arbre = getArbreSemantic(arbreSemantic)
+    resultat = cacheFormesNormals.obtenir(str_arbre)
+
+    if resultat and resultat[2] <= maxBetaReduccions:
+        nouArbre, nAlpha, nBeta = resultat
+        estat = 'Forma normal'
     else:
-        await update.message.reply_html('<b>ERROR DE SINTAXIS\n</b>Hi ha ' + str(parser.getNumberOfSyntaxErrors()) + " errors de sintaxi. No s'ha pogut avaluar l'expressió.")
+        midaMaxima = context.user_data['mida_divergencia']
+        heuristiques = context.user_data['deteccio_divergencia']
+        progres = cacheProgres.obtenir(str_arbre)
+        # Només continuem el progrés d'un altre usuari si no supera el nostre màxim de beta reduccions
+        if progres and progres[2] <= maxBetaReduccions:
+            # El progrés és compartit: treballem sobre una còpia del detector
+            nouArbre, nAlpha, nBeta, detector = progres
+            detector = detector.copia(midaMaxima, heuristiques)
+        else:
+            nouArbre, nAlpha, nBeta = arbreSemantic, 0, 0
+            detector = DetectorDivergencia(arbreSemantic, midaMaxima, heuristiques)
+        estat = None
+
+        while estat is None:
+            if detector.resultat == CICLE:
+                estat = 'El terme entra en un bucle'
+            elif detector.resultat in [CREIXEMENT, AUTOREPRODUCCIO]:
+                estat = 'Probablement divergent'
+            elif nBeta >= maxBetaReduccions:
+                estat = "S'ha arribat al màxim de beta reduccions"
+            elif time.monotonic() - inici > PRESSUPOST_INLINE:
+                estat = 'Resultat parcial'
+            else:
+                # Cedim el control entre passos i abandonem la consulta si n'ha arribat una de més nova.
+                # El progrés es desa a cada pas, de manera que la consulta nova el pot continuar.
+                await asyncio.sleep(0)
+                if context.user_data['consulta_inline'] != query.id:
+                    return
+
+                nouArbre, pas = reduirPas(nouArbre)
+                if pas is None:
+                    estat = 'Forma normal'
+                elif pas.tipus == 'α':
+                    nAlpha += 1
+                else:
+                    nBeta += 1
+                    detector.observar(nouArbre, pas)
+
+                if pas is not None:
+                    desarProgres(str_arbre, (nouArbre, nAlpha, nBeta, detector.copia()))
+
+        if estat == 'Forma normal':
+            cacheFormesNormals.desar(str_arbre, (nouArbre, nAlpha, nBeta))
+            cacheProgres.eliminar(str_arbre)
+
+    str_nouArbre = getArbreSemantic(nouArbre)
+    resultat = InlineQueryResultArticle(
+        id=str(uuid.uuid4()),
+        title=retallar(str_nouArbre, MAX_LLARGADA_TITOL),
+        description=estat + ' (' + str(nAlpha) + ' alpha conversions, ' + str(nBeta) + ' beta reduccions)',
+        input_message_content=InputTextMessageContent(retallar(str_arbre + ' → ' + str_nouArbre, MAX_LLARGADA_MISSATGE)))
+    await query.answer([resultat], cache_time=0, is_personal=True)
 
 
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -722,10 +1570,35 @@ if __name__ == '__main__':
     Funció principal que inicialitza i executa el bot.
 
     La funció crea una instància de l'ApplicationBuilder i afegeix els gestors de comandes i missatges.
-    També executa el bot fins que es premi CTRL+C.
+    També executa el bot fins que es premi CTRL+C, rebent les actualitzacions per polling o per webhook.
 
     """
-    application = ApplicationBuilder().token(TOKEN).build()
+    argParser = argparse.ArgumentParser(description='LambdaCalculBot: bot de Telegram que avalua expressions en lambda càlcul.')
+    argParser.add_argument('--token', help='Token del bot. Per defecte es llegeix de token.txt.')
+    argParser.add_argument('--api-url', help="URL base de l'API de Telegram (per exemple, http://127.0.0.1:8081/bot).")
+    argParser.add_argument('--webhook', action='store_true', help='Rep les actualitzacions per webhook en lloc de fer polling.')
+    argParser.add_argument('--host', default='0.0.0.0', help='Adreça on escolta el servidor del webhook.')
+    argParser.add_argument('--port', type=int, default=8443, help='Port on escolta el servidor del webhook.')
+    argParser.add_argument('--path', default='webhook', help='Ruta del webhook.')
+    argParser.add_argument('--secret', help='Secret que Telegram envia a la capçalera X-Telegram-Bot-Api-Secret-Token.')
+    argParser.add_argument('--webhook-url', help='URL pública del webhook que es registra a Telegram.')
+    args = argParser.parse_args()
+
+    if args.webhook and not args.webhook_url:
+        argParser.error('--webhook necessita --webhook-url amb la URL pública que es registra a Telegram')
+    if args.webhook and not args.secret:
+        logger.warning('El webhook no té --secret: qualsevol pot enviar-hi actualitzacions falses')
+
+    token = args.token or open('token.txt').read().strip()
+
+    # Processem les actualitzacions concurrentment perquè una avaluació llarga no bloquegi la resta
+    async def aturarPlanificador(application) -> None:
+        await planificador.aturar()
+
+    builder = ApplicationBuilder().token(token).concurrent_updates(True).post_stop(aturarPlanificador)
+    if args.api_url:
+        builder = builder.base_url(args.api_url)
+    application = builder.build()
 
     # Commands
     start_handler = CommandHandler('start', start)
@@ -735,7 +1608,10 @@ if __name__ == '__main__':
     config_handler = CommandHandler('config', config)
     set_handler = CommandHandler('set', set)
     importar_macros_handler = CommandHandler('importar_macros', importar_macros)
+    cancel_handler = CommandHandler('cancel', cancel)
+    trace_handler = CommandHandler('trace', trace)
     echo_handler = MessageHandler(filters.TEXT & (~filters.COMMAND), echo)
+    inline_handler = InlineQueryHandler(inline)
 
     # Handlers
     application.add_handler(start_handler)
@@ -745,11 +1621,18 @@ if __name__ == '__main__':
     application.add_handler(config_handler)
     application.add_handler(set_handler)
     application.add_handler(importar_macros_handler)
+    application.add_handler(cancel_handler)
+    application.add_handler(trace_handler)
     application.add_handler(echo_handler)
+    application.add_handler(inline_handler)
 
     # Others (This handler must be added last)
     unknown_handler = MessageHandler(filters.COMMAND, unknown)
     application.add_handler(unknown_handler)
 
     # Runs the bot until you hit CTRL+C
-    application.run_polling()
+    if args.webhook:
+        application.run_webhook(listen=args.host, port=args.port, url_path=args.path,
+                                secret_token=args.secret, webhook_url=args.webhook_url)
+    else:
+        application.run_polling()
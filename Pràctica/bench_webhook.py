@@ -0,0 +1,193 @@
+"""
+Banc de proves del mode webhook de LambdaCalculBot.
+
+Arrenca un servidor local que fa de l'API de Telegram, executa el bot en mode webhook apuntant-hi,
+i envia actualitzacions al webhook des de diversos usuaris simulats alhora. Mesura la latència fins a
+la primera resposta i fins al resultat final de cada avaluació, i el rendiment global, sense necessitat
+de connexió a Telegram.
+
+Ús:
+    python3.10 bench_webhook.py --usuaris 20 --peticions 10 --expressio '(λx.x)y'
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+import tornado.web
+
+SECRET = 'bench-secret'
+TOKEN = '123456:BENCH'
+
+
+class ApiTelegramFalsa:
+    """
+    Servidor que imita els mètodes de l'API de Telegram que fa servir el bot.
+    Cada missatge que el bot envia a un xat es notifica a la cua d'aquell xat.
+    """
+
+    def __init__(self):
+        self.cues: dict[int, asyncio.Queue] = {}
+        self.webhookRegistrat = asyncio.Event()
+        self.nMissatge = 0
+
+    def cua(self, chat_id: int) -> asyncio.Queue:
+        return self.cues.setdefault(chat_id, asyncio.Queue())
+
+    def resultat(self, metode: str, params: dict):
+        """
+        Retorna el resultat que l'API de Telegram donaria per al mètode cridat.
+        """
+        if metode == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'LambdaCalculBot', 'username': 'LambdaCalculBot'}
+
+        if metode == 'setWebhook':
+            self.webhookRegistrat.set()
+            return True
+
+        if metode in ['sendMessage', 'sendPhoto']:
+            chat_id = int(params['chat_id'])
+            text = params.get('text', '')
+            self.cua(chat_id).put_nowait((time.monotonic(), text))
+            self.nMissatge += 1
+            return {'message_id': self.nMissatge, 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+
+        return True
+
+    def aplicacio(self) -> tornado.web.Application:
+        api = self
+
+        class Gestor(tornado.web.RequestHandler):
+            def post(self, token, metode):
+                if self.request.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(self.request.body or b'{}')
+                else:
+                    params = {k: self.get_body_argument(k) for k in self.request.body_arguments}
+                self.write({'ok': True, 'result': api.resultat(metode, params)})
+
+        return tornado.web.Application([(r'/bot([^/]+)/(\w+)', Gestor)])
+
+
+def actualitzacio(update_id: int, usuari: int, text: str) -> dict:
+    """
+    Construeix una actualització de Telegram amb un missatge de text d'un usuari.
+    """
+    persona = {'id': usuari, 'is_bot': False, 'first_name': 'Bench'}
+    missatge = {'message_id': update_id, 'date': int(time.time()), 'text': text,
+                'chat': {'id': usuari, 'type': 'private', 'first_name': 'Bench'}, 'from': persona}
+    if text.startswith('/'):
+        missatge['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': missatge}
+
+
+async def simularUsuari(client: httpx.AsyncClient, url: str, api: ApiTelegramFalsa, usuari: int,
+                        expressio: str, peticions: int, temps: float, ids, latencies: list, totals: list,
+                        fallades: list) -> None:
+    """
+    Envia les peticions d'un usuari una darrere l'altra i en mesura les latències.
+    Si una resposta no arriba en 'temps' segons, la petició compta com a fallada i l'usuari deixa
+    d'enviar-ne més, perquè les respostes endarrerides alterarien les mesures següents.
+    """
+    cua = api.cua(usuari)
+    capcalera = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+
+    try:
+        # Desactivem les imatges perquè el banc mesuri el camí del webhook i no GraphViz
+        await client.post(url, json=actualitzacio(next(ids), usuari, '/set mostrar_imatges no'), headers=capcalera)
+        await asyncio.wait_for(cua.get(), timeout=temps)
+    except asyncio.TimeoutError:
+        fallades.append(usuari)
+        return
+
+    for _ in range(peticions):
+        inici = time.monotonic()
+        await client.post(url, json=actualitzacio(next(ids), usuari, expressio), headers=capcalera)
+        try:
+            primera, _ = await asyncio.wait_for(cua.get(), timeout=temps)
+            latencies.append(primera - inici)
+
+            # L'avaluació acaba amb el missatge d'estadístiques
+            while True:
+                final, text = await asyncio.wait_for(cua.get(), timeout=temps)
+                if 'Estadístiques' in text:
+                    break
+            totals.append(final - inici)
+        except asyncio.TimeoutError:
+            fallades.append(usuari)
+            return
+
+
+def percentil(valors: list, p: float) -> float:
+    """
+    Retorna el percentil 'p' (entre 0 i 1) dels valors.
+    """
+    ordenats = sorted(valors)
+    return ordenats[min(len(ordenats) - 1, int(p * len(ordenats)))]
+
+
+async def main(args) -> None:
+    api = ApiTelegramFalsa()
+    servidor = api.aplicacio().listen(args.port_api, address='127.0.0.1')
+
+    url = 'http://127.0.0.1:' + str(args.port_webhook) + '/webhook'
+    bot = subprocess.Popen([sys.executable, 'achurch.py', '--webhook',
+                            '--host', '127.0.0.1', '--port', str(args.port_webhook), '--path', 'webhook',
+                            '--secret', SECRET, '--webhook-url', url, '--token', TOKEN,
+                            '--api-url', 'http://127.0.0.1:' + str(args.port_api) + '/bot'],
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        await asyncio.wait_for(api.webhookRegistrat.wait(), timeout=30)
+
+        ids = iter(range(1, 10**9))
+        latencies, totals, fallades = [], [], []
+        async with httpx.AsyncClient(timeout=60) as client:
+            # Esperem que el servidor del webhook accepti connexions
+            while True:
+                try:
+                    await client.get(url)
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+
+            inici = time.monotonic()
+            await asyncio.gather(*[simularUsuari(client, url, api, usuari, args.expressio, args.peticions,
+                                                 args.timeout, ids, latencies, totals, fallades)
+                                   for usuari in range(1, args.usuaris + 1)])
+            durada = time.monotonic() - inici
+
+        print('Peticions: ' + str(len(totals)) + ' (' + str(args.usuaris) + ' usuaris)')
+        if fallades:
+            print('Fallades: ' + str(len(fallades)) + ' peticions sense resposta completa en ' + str(args.timeout) +
+                  "s. Comprova que l'expressió és correcta i fa com a mínim una reducció.")
+        print('Durada: {:.2f}s'.format(durada))
+        print('Rendiment: {:.1f} avaluacions/s'.format(len(totals) / durada))
+        for nom, valors in [('Primera resposta', latencies), ('Resultat final', totals)]:
+            if not valors:
+                continue
+            print(nom + ': mitjana {:.1f}ms, p50 {:.1f}ms, p95 {:.1f}ms, màxim {:.1f}ms'.format(
+                statistics.mean(valors) * 1000, percentil(valors, 0.5) * 1000,
+                percentil(valors, 0.95) * 1000, max(valors) * 1000))
+    finally:
+        bot.terminate()
+        bot.wait()
+        servidor.stop()
+
+
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Banc de proves del mode webhook de LambdaCalculBot.')
+    argParser.add_argument('--usuaris', type=int, default=10, help="Nombre d'usuaris simulats concurrents.")
+    argParser.add_argument('--peticions', type=int, default=10, help='Nombre de peticions per usuari.')
+    argParser.add_argument('--expressio', default='(λx.x)y',
+                           help='Expressió que envien els usuaris. Ha de fer com a mínim una reducció.')
+    argParser.add_argument('--port-api', type=int, default=8081, help="Port de l'API de Telegram falsa.")
+    argParser.add_argument('--port-webhook', type=int, default=8443, help='Port del webhook del bot.')
+    argParser.add_argument('--timeout', type=float, default=30,
+                           help='Temps màxim (en segons) per esperar cada resposta del bot.')
+    asyncio.run(main(argParser.parse_args()))